@@ -12,11 +12,11 @@ If running on CPU-only, this script may be slow.
 import os
 import argparse
 import random
-import copy
 import glob
 
 import torch
 from torchvision.transforms import functional as F
+from torchvision.ops import nms as tv_nms
 from PIL import Image, ImageOps
 
 from darknet import Darknet, get_test_input
@@ -29,7 +29,6 @@ from bbox import center_to_corner, center_to_corner_2d
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import cv2
 import pickle as pkl
 
@@ -59,6 +58,12 @@ def arg_parse():
                         help="Overlap threshhold", default=0.5)
     parser.add_argument("--plot-conf", dest="plot_conf", type=float,
                         help="Bounding box plotting confidence", default=0.8)
+    parser.add_argument("--bs", dest="bs", type=int,
+                        help="Batch size", default=8)
+    parser.add_argument("--workers", dest="workers", type=int,
+                        help="Number of data loading worker processes", default=4)
+    parser.add_argument("--no-compile", dest="compile", action="store_false",
+                        help="Don't torch.compile the model on CUDA")
     return parser.parse_args()
 
 # Original author: Francisco Massa:
@@ -75,85 +80,38 @@ def nms(boxes, scores, overlap=0.5, top_k=200):
     Return:
         The indices of the kept boxes with respect to num_priors.
     """
-
-    keep = scores.new(scores.size(0)).zero_().long()
-    if boxes.numel() == 0:
-        return keep, 0
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    area = torch.mul(x2 - x1, y2 - y1)
-    v, idx = scores.sort(0)  # sort in ascending order
-    # I = I[v >= 0.01]
-    idx = idx[-top_k:]  # indices of the top-k largest vals
-    xx1 = boxes.new()
-    yy1 = boxes.new()
-    xx2 = boxes.new()
-    yy2 = boxes.new()
-    w = boxes.new()
-    h = boxes.new()
-
-    count = 0
-    while idx.numel() > 0:
-        i = idx[-1]  # index of current largest val
-        # keep.append(i)
-        keep[count] = i
-        count += 1
-        if idx.size(0) == 1:
-            break
-        idx = idx[:-1]  # remove kept element from view
-        # load bboxes of next highest vals
-        torch.index_select(x1, 0, idx, out=xx1)
-        torch.index_select(y1, 0, idx, out=yy1)
-        torch.index_select(x2, 0, idx, out=xx2)
-        torch.index_select(y2, 0, idx, out=yy2)
-        # store element-wise max with next highest score
-        xx1 = torch.clamp(xx1, min=x1[i])
-        yy1 = torch.clamp(yy1, min=y1[i])
-        xx2 = torch.clamp(xx2, max=x2[i])
-        yy2 = torch.clamp(yy2, max=y2[i])
-        w.resize_as_(xx2)
-        h.resize_as_(yy2)
-        w = xx2 - xx1
-        h = yy2 - yy1
-        # check sizes of xx1 and xx2.. after each iteration
-        w = torch.clamp(w, min=0.0)
-        h = torch.clamp(h, min=0.0)
-        inter = w*h
-        # IoU = i / (area(a) + area(b) - i)
-        rem_areas = torch.index_select(area, 0, idx)  # load remaining areas)
-        union = (rem_areas - inter) + area[i]
-        IoU = inter/union  # store result in iou
-        # keep only elements with an IoU <= overlap
-        idx = idx[IoU.le(overlap)]
-    return keep, count
+    # torchvision's kernel runs on the device the boxes already live on
+    scores = scores.float()
+    top_scores, idx = scores.topk(min(top_k, scores.size(0)))
+    boxes = boxes.to(scores.device, dtype=torch.float)
+    keep = idx[tv_nms(boxes[idx], top_scores, overlap)]
+    return keep, keep.numel()
 
 def bbox_iou(box1, box2):
     """
-    Returns the IoU of two bounding boxes 
+    Returns the pairwise IoU of two sets of bounding boxes
 
-    Input boxes are expected to be in x1y1x2y2 format.
+    Input boxes are expected to be in x1y1x2y2 format, box1 of shape [N, 4]
+    and box2 of shape [M, 4].  The result has shape [N, M].
     """
-    #Get the coordinates of bounding boxes
-    b1_x1, b1_y1, b1_x2, b1_y2 = box1[:,0], box1[:,1], box1[:,2], box1[:,3]
-    b2_x1, b2_y1, b2_x2, b2_y2 = box2[:,0], box2[:,1], box2[:,2], box2[:,3]
-    
+    #Broadcast [N, 1, 4] against [1, M, 4]
+    b1 = box1[:, None]
+    b2 = box2[None, :]
+
     #get the corrdinates of the intersection rectangle
-    inter_rect_x1 =  torch.max(b1_x1, b2_x1)
-    inter_rect_y1 =  torch.max(b1_y1, b2_y1)
-    inter_rect_x2 =  torch.min(b1_x2, b2_x2)
-    inter_rect_y2 =  torch.min(b1_y2, b2_y2)
-    
+    inter_tl = torch.max(b1[..., :2], b2[..., :2])
+    inter_br = torch.min(b1[..., 2:4], b2[..., 2:4])
+
     #Intersection area
-    inter_area = torch.clamp(inter_rect_x2 - inter_rect_x1 + 1, min=0) * torch.clamp(inter_rect_y2 - inter_rect_y1 + 1, min=0)
+    inter_wh = torch.clamp(inter_br - inter_tl + 1, min=0)
+    inter_area = inter_wh[..., 0] * inter_wh[..., 1]
 
     #Union Area
-    b1_area = (b1_x2 - b1_x1 + 1)*(b1_y2 - b1_y1 + 1)
-    b2_area = (b2_x2 - b2_x1 + 1)*(b2_y2 - b2_y1 + 1)
-    
-    iou = inter_area / (b1_area + b2_area - inter_area)
-    
+    b1_area = (box1[:, 2] - box1[:, 0] + 1)*(box1[:, 3] - box1[:, 1] + 1)
+    b2_area = (box2[:, 2] - box2[:, 0] + 1)*(box2[:, 3] - box2[:, 1] + 1)
+
+    iou = inter_area / (b1_area[:, None] + b2_area[None, :] - inter_area)
+
     return iou
 
 def average_precision(rec, prec, use_07_metric=False):
@@ -163,14 +121,12 @@ def average_precision(rec, prec, use_07_metric=False):
     VOC 07 11 point method (default:True).
     """
     if use_07_metric:
-        # 11 point metric
-        ap = 0.
-        for t in np.arange(0., 1.1, 0.1):
-            if np.sum(rec >= t) == 0:
-                p = 0
-            else:
-                p = np.max(prec[rec >= t])
-            ap = ap + p / 11.
+        # 11 point metric: max precision at recall >= t (0 if none), for
+        # all thresholds t at once
+        thresholds = np.arange(0., 1.1, 0.1)
+        above = rec[np.newaxis, :] >= thresholds[:, np.newaxis]
+        p = np.max(np.where(above, prec[np.newaxis, :], 0.), axis=1, initial=0.)
+        ap = np.sum(p / 11.)
     else:
         # correct AP calculation
         # first append sentinel values at the end
@@ -178,8 +134,7 @@ def average_precision(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -218,20 +173,16 @@ def custom_eval(predictions_all,
         sorted_scores = np.sort(-confidence)
         BB = BB[sorted_ind, :]
 
-        BBGT = ground_truths[:, :4]
-        nd = BB.shape[0]
-        ngt = BBGT.shape[0]
-        
-        # Go down detections and ground truths and calc overlaps (IOUs)
-        overlaps = []
-        for d in range(nd):
-            bb = BB[d]
-            for gt in range(ngt):
-                bbox1 = torch.tensor(BBGT[np.newaxis, gt, :], dtype=torch.float)
-                bbox2 = torch.tensor(bb[np.newaxis, :].clone().detach(), dtype=torch.float)
-                overlaps.append(bbox_iou(bbox1, bbox2))
+        BB = np.asarray(BB, dtype=np.float32)
+        BBGT = np.asarray(ground_truths[:, :4], dtype=np.float32)
+
+        # Calc overlaps (IOUs) between all detections and ground truths at
+        # once, on the same device the model ran on
+        BB = torch.from_numpy(BB).to(device, non_blocking=True)
+        BBGT = torch.from_numpy(BBGT).to(device, non_blocking=True)
+        overlaps = bbox_iou(BB, BBGT)
         # Get best IOU prediction/gt match
-        ovmax = np.max(np.array(overlaps))
+        ovmax = overlaps.max().item()
 
         # Mark TPs and FPs
         if ovmax > ovthresh:
@@ -250,7 +201,18 @@ def custom_eval(predictions_all,
 
     return rec, prec, ap
 
-def write(x, img):
+def collate_fn(batch):
+    """
+    Stack the images of a batch, which all share the model input size, and
+    keep the ground truths (possibly empty) and file paths as lists.
+    """
+    images, ground_truths, filepaths = zip(*batch)
+    return torch.stack(images, 0), list(ground_truths), list(filepaths)
+
+# Size of each (label, scale_up) text box drawn by write()
+_TEXT_SIZE_CACHE = {}
+
+def write(x, img, scale_up):
     """
     Arguments
     ---------
@@ -258,6 +220,8 @@ def write(x, img):
         [batch_index, x1, y1, x2, y2, objectness, label, probability]
     img : numpy array
         original image
+    scale_up : int
+        Thickness multiplier for lines to match size of original image
 
     Returns
     -------
@@ -265,20 +229,20 @@ def write(x, img):
         Image with bounding box drawn
     """
 
-    # Scale up thickness of lines to match size of original image
-    scale_up = int(img.shape[0]/416)
-
     if x[-1] is not None:
         c1 = tuple([int(y) for y in x[[0,1]]])
         c2 = tuple([int(y) for y in x[[2,3]]])
-        label = int(x[-2])
-        label = "{0}".format(classes[label])
-        color = random.choice(colors)
+        label_idx = int(x[-2])
+        label = "{0}".format(classes[label_idx])
+        color = colors[label_idx % len(colors)]
         cv2.rectangle(img, c1, c2, color, 1*scale_up)
-        t_size = cv2.getTextSize(text=label,
-                                 fontFace=cv2.FONT_HERSHEY_PLAIN, 
-                                 fontScale=1*scale_up//2, 
-                                 thickness=1*scale_up)[0]
+        t_size = _TEXT_SIZE_CACHE.get((label_idx, scale_up))
+        if t_size is None:
+            t_size = cv2.getTextSize(text=label,
+                                     fontFace=cv2.FONT_HERSHEY_PLAIN, 
+                                     fontScale=1*scale_up//2, 
+                                     thickness=1*scale_up)[0]
+            _TEXT_SIZE_CACHE[(label_idx, scale_up)] = t_size
         c2 = c1[0] + t_size[0] + 3, c1[1] + t_size[1] + 4
         cv2.rectangle(img, c1, c2, color, thickness=-1)
         cv2.putText(img, label, (c1[0], c1[1] + t_size[1] + 4), 
@@ -291,6 +255,7 @@ def write(x, img):
 if __name__ == "__main__":
     args = arg_parse()
     overlap_thresh = float(args.overlap_thresh)
+    plot_conf = float(args.plot_conf)
 
     # Instantiate a model
     model = Darknet(args.cfgfile, train=False)
@@ -313,6 +278,12 @@ if __name__ == "__main__":
     # Make sure to call eval() method after loading weights
     model.eval()
 
+    # Specialize the model for the fixed eval input shape (PyTorch >= 2.0).
+    # Only the last, smaller batch triggers a recompilation.  reduce-overhead
+    # relies on CUDA graphs, so this is not worth the compile time on CPU.
+    if args.compile and device.type == 'cuda' and hasattr(torch, 'compile'):
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
     # Load test data
     transforms = Sequence([YoloResizeTransform(model_dim), Normalize()])
     test_data = CustomDataset(root="data", ann_file="data/test.txt", 
@@ -320,8 +291,12 @@ if __name__ == "__main__":
                               cfg_file=args.cfgfile,
                               num_classes=num_classes)
     test_loader = DataLoader(test_data, 
-                             batch_size=1,
-                             shuffle=False)
+                             batch_size=args.bs,
+                             shuffle=False,
+                             collate_fn=collate_fn,
+                             num_workers=args.workers,
+                             pin_memory=torch.cuda.is_available(),
+                             persistent_workers=args.workers > 0)
 
     ground_truths_all = []
     predictions_all = []
@@ -329,87 +304,86 @@ if __name__ == "__main__":
 
     # Make a directory for the image files with their bboxes
     os.makedirs('eval_output', exist_ok=True)
-    
-    # Get image files to match "image" from test_loader which does alphabetical
-    with open(os.path.join('data', 'test.txt'), 'r') as f:
-        files_grabbed = f.readlines()
-        files_grabbed = [x.rstrip() for x in files_grabbed]
-    files_grabbed.sort()
-
-    for i, (image, ground_truth, filepath) in enumerate(test_loader):
-        
-        img_file = filepath[0].rstrip()
-        img_ = plt.imread(img_file)
-        orig_h, orig_w = img_.shape[0], img_.shape[1]
-        orig_dim = torch.FloatTensor([orig_w, orig_h]).repeat(1,2)
-        print(img_file)
-        print(i)
-
-        ground_truths = []
-        if len(ground_truth) == 0:
-            continue
-        else:
-            ground_truths.append(ground_truth)
 
+    # Class names and box colors used by write() to plot bboxes
+    classes = load_classes(os.path.join("data", "classes.names"))
+    colors = pkl.load(open("pallete", "rb"))
 
-        # predict on input test image
-        image = image.to(device)
-        with torch.no_grad():        
-            output = model(image).to(device)
+    i = 0
+    for images, ground_truth_batch, filepaths in test_loader:
 
-        # NB, output is:
+        # predict on the whole batch of input test images at once
+        images = images.to(device, non_blocking=True)
+        # Run in FP16 on the GPU, box math below expects FP32 again
+        with torch.inference_mode(), torch.autocast(device.type, dtype=torch.float16,
+                                                    enabled=device.type == 'cuda'):
+            output_batch = model(images)
+        output_batch = output_batch.float()
+
+        # NB, output_batch is:
         # [batch, image_id, [x_center, y_center, width, height, objectness_score, class_score1, class_score2, ...]]
-        
-        if output.shape[0] > 0:
-            # To later plot bboxes
-            img_ = plt.imread(img_file)
-
-            output = output.squeeze(0)
-
-            for i in range(output.shape[0]):
-                if output[i, -1] >= float(args.plot_conf):
-                    logwriter.write('output before center2corner,' + ','.join([str(x.item()) for x in output[i]]) + '\n')
-
-            output = process_output(output, num_classes)
-
-            # Center to corner
-            output_ = copy.deepcopy(output).to(device)
-            output[:,0] = output_[:,0] - output_[:,2]/2
-            output[:,1] = output_[:,1] - output_[:,3]/2
-            output[:,2] = output_[:,0] + output_[:,2]/2
-            output[:,3] = output_[:,1] + output_[:,3]/2
-
-            # Scale
-            # scaling_factor = torch.min(model_dim/orig_dim[:,[0,1]],1)[0].view(-1,1)
-            output = output[output[:,-1] > float(args.plot_conf), :]
-            outputs = []
-            if output.size(0) > 0:
-                scale = float(model_dim)/orig_dim
-                orig_dim = orig_dim.repeat(output.size(0), 1)
-                output[:,:4] /= scale
-                print('orig dim ', orig_dim)
-                # output[:,[0,2]] -= (model_dim - scaling_factor*orig_dim[0,0])/2
-                output[:, [0,2]] = torch.clamp(output[:,[0,2]], 0.0, orig_dim[0,0])
-                output[:, [1,3]] = torch.clamp(output[:,[1,3]], 0.0, orig_dim[0,1])
-                outputs = list(np.asarray(output[:,:8]))
-
-            classes = load_classes(os.path.join("data", "classes.names"))
-            colors = pkl.load(open("pallete", "rb"))
-            
-            # # Test resizing to model dim
-            # img_ = Image.fromarray(np.uint8(img_))
-            # img_ = F.resize(img_, (model_dim, model_dim))
-            # img_ = np.asarray(img_)
-            list(map(lambda x: write(x, img_), outputs))
-            
-            # Write image with bboxes to a new folder
-            plt.imsave(img_file.replace('.'+img_file.split('.')[-1], '_out.jpg').replace(
-                img_file.split(os.sep)[-2], 'eval_output'), img_)
-
-            outputs = torch.tensor(outputs)
-
-            ground_truths_all.append(ground_truths)
-            predictions_all.append(outputs)
+
+        for output, ground_truth, filepath in zip(output_batch, ground_truth_batch, filepaths):
+
+            img_file = filepath.rstrip()
+            print(img_file)
+            print(i)
+            i += 1
+
+            # Keep the [1, N, 6] batch-of-one shape the ground truths had
+            # with batch_size=1; images without annotations are still evaluated
+            ground_truths = [ground_truth.unsqueeze(0)]
+
+            # Read the original image once, for its size and to plot bboxes on
+            img_ = cv2.imread(img_file)
+            if img_ is None:
+                raise IOError("Could not read image %s" % img_file)
+            orig_h, orig_w = img_.shape[0], img_.shape[1]
+            orig_dim = torch.FloatTensor([orig_w, orig_h]).repeat(1,2)
+
+            if output.shape[0] > 0:
+                if DEBUG:
+                    kept = output[output[:,-1] >= plot_conf]
+                    for row in kept.tolist():
+                        logwriter.write('output before center2corner,' + ','.join(map(str, row)) + '\n')
+
+                output = process_output(output, num_classes)
+
+                # Center to corner
+                half_wh = output[:,2:4]/2
+                output[:,:4] = torch.cat((output[:,:2] - half_wh, output[:,:2] + half_wh), 1)
+
+                # Scale
+                # scaling_factor = torch.min(model_dim/orig_dim[:,[0,1]],1)[0].view(-1,1)
+                output = output[output[:,-1] > plot_conf, :]
+                if output.size(0) > 0:
+                    scale = float(model_dim)/orig_dim
+                    output[:,:4] /= scale.to(output.device)
+                    print('orig dim ', orig_w, orig_h)
+                    # output[:,[0,2]] -= (model_dim - scaling_factor*orig_dim[0,0])/2
+                    output[:,0].clamp_(0.0, orig_w)
+                    output[:,2].clamp_(0.0, orig_w)
+                    output[:,1].clamp_(0.0, orig_h)
+                    output[:,3].clamp_(0.0, orig_h)
+                boxes_np = output[:,:8].detach().cpu().numpy()
+
+                # # Test resizing to model dim
+                # img_ = Image.fromarray(np.uint8(img_))
+                # img_ = F.resize(img_, (model_dim, model_dim))
+                # img_ = np.asarray(img_)
+                # Scale up thickness of lines to match size of original image
+                scale_up = int(orig_h/416)
+                for row in boxes_np:
+                    write(row, img_, scale_up)
+
+                # Write image with bboxes to a new folder
+                base = os.path.splitext(os.path.basename(img_file))[0]
+                out_file = os.path.join('eval_output', base + '_out.jpg')
+                if not cv2.imwrite(out_file, img_):
+                    raise IOError("Could not write image %s" % out_file)
+
+                ground_truths_all.append(ground_truths)
+                predictions_all.append(torch.from_numpy(boxes_np))
 
     # prec, rec, aps = custom_eval(predictions_all, ground_truths_all, num_gts=num_gts, ovthresh=overlap_thresh)
     # print('Precision ', prec, 'Recall ', rec, 'Average precision ', np.mean(aps), sep='\n')